@@ -4,21 +4,59 @@ Basic OpenAI Computer Using Agent (CUA) implementation
 """
 
 import os
+import asyncio
 import base64
 import json
 import re
-import time
 from io import BytesIO
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from dataclasses import dataclass
 
-from openai import OpenAI
-from playwright.sync_api import sync_playwright, Page, Browser
+from openai import AsyncOpenAI
+from playwright.async_api import async_playwright, Page, Browser, BrowserContext
 from PIL import Image
 from dotenv import load_dotenv
 
 load_dotenv()
 
+_JSON_FENCE = re.compile(r'```json\s*(\{.*?\})\s*```', re.DOTALL)
+# Bounded one-level nesting instead of greedy .* to avoid catastrophic backtracking
+_JSON_OBJ = re.compile(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', re.DOTALL)
+_ACTION_NAME = re.compile(r'"action"\s*:\s*"([^"]+)"')
+
+def _extract_action_json(response_text: str) -> Optional[Dict[str, Any]]:
+    """Extract the action JSON object from a model response"""
+    # Fast path: responses are usually a bare JSON object
+    try:
+        return json.loads(response_text.strip())
+    except json.JSONDecodeError:
+        pass
+
+    # Fenced block via plain string slicing, no regex
+    fenced = response_text.partition("```json")[2].partition("```")[0]
+    if fenced.strip():
+        try:
+            return json.loads(fenced)
+        except json.JSONDecodeError:
+            pass
+
+    # Last resort: precompiled patterns
+    match = _JSON_FENCE.search(response_text)
+    if match:
+        try:
+            return json.loads(match.group(1))
+        except json.JSONDecodeError:
+            pass
+
+    match = _JSON_OBJ.search(response_text)
+    if match:
+        try:
+            return json.loads(match.group())
+        except json.JSONDecodeError:
+            pass
+
+    return None
+
 @dataclass
 class CUAConfig:
     openai_api_key: str
@@ -26,139 +64,241 @@ class CUAConfig:
     max_steps: int = 10
     viewport_width: int = 1280
     viewport_height: int = 720
+    history_window: int = 4
+    headless: bool = True
+    jpeg_quality: int = 60
+
+# Trim Chromium startup when nothing is rendered to a display
+_LAUNCH_ARGS = ["--disable-dev-shm-usage", "--no-sandbox", "--disable-gpu"]
+
+# dHash hamming distance below which two screenshots count as the same page
+_UNCHANGED_HASH_DISTANCE = 3
+
+def _dhash(image_bytes: bytes) -> int:
+    """64-bit difference hash of a screenshot for change detection"""
+    img = Image.open(BytesIO(image_bytes)).convert('L').resize((9, 8))
+    pixels = list(img.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col + 1] > pixels[row * 9 + col])
+    return value
+
+class BrowserPool:
+    """One warm Chromium shared across tasks; contexts are cheap and isolated"""
+
+    def __init__(self, headless: bool = True):
+        self.headless = headless
+        self.playwright = None
+        self.browser: Optional[Browser] = None
+        self._launch_lock = asyncio.Lock()
+
+    async def acquire(self, viewport: Dict[str, int]) -> BrowserContext:
+        """Hand out a fresh context (own cookies/storage) from the warm browser"""
+        if not self.browser:
+            # Serialize the lazy launch; concurrent acquires would each start
+            # their own Chromium and leak all but the last one
+            async with self._launch_lock:
+                if not self.browser:
+                    self.playwright = await async_playwright().start()
+                    self.browser = await self.playwright.chromium.launch(
+                        headless=self.headless, args=_LAUNCH_ARGS
+                    )
+        return await self.browser.new_context(viewport=viewport)
+
+    async def release(self, context: BrowserContext):
+        await context.close()
+
+    async def stop(self):
+        """Shut down the shared browser"""
+        if self.browser:
+            await self.browser.close()
+            self.browser = None
+        if self.playwright:
+            await self.playwright.stop()
+            self.playwright = None
+
+_SYSTEM_PROMPT = """You are a computer-using agent. Analyze the screenshot and provide the next action to take.
+
+Available actions:
+- type_search_query: Type text in search field. Format: {"action": "type_search_query", "details": {"query": "text to type"}}
+- click: Click at coordinates or selector. Format: {"action": "click", "details": {"x": 100, "y": 200}} or {"action": "click", "details": {"selector": "button"}}
+- press_enter: Press Enter key. Format: {"action": "press_enter", "details": {}}
+- click_search: Click search button. Format: {"action": "click_search", "details": {}}
+- scroll: Scroll page. Format: {"action": "scroll", "details": {"delta_y": 300}}
+- wait: Wait for seconds. Format: {"action": "wait", "details": {"seconds": 2}}
+
+Always respond with valid JSON in the format above. If the task appears complete, include "task_complete": true in your response."""
 
 class ComputerUsingAgent:
-    def __init__(self, config: CUAConfig):
+    # Shared, never mutated; avoids rebuilding the same dict every step
+    _SYSTEM_MSG = {"role": "system", "content": _SYSTEM_PROMPT}
+
+    def __init__(self, config: CUAConfig, pool: Optional[BrowserPool] = None):
         self.config = config
-        self.client = OpenAI(api_key=config.openai_api_key)
+        self.client = AsyncOpenAI(api_key=config.openai_api_key)
+        self.pool = pool
+        self._messages: List[Dict] = [self._SYSTEM_MSG]
+        self._condensed_upto = 1
         self.browser: Optional[Browser] = None
+        self.context: Optional[BrowserContext] = None
         self.page: Optional[Page] = None
         self.playwright = None
-        
-    def start_browser(self):
-        """Initialize browser and page"""
-        self.playwright = sync_playwright().start()
-        self.browser = self.playwright.chromium.launch(headless=False)
-        self.page = self.browser.new_page()
-        self.page.set_viewport_size({
-            'width': self.config.viewport_width, 
+        self._screenshot_hash: Optional[int] = None
+        self._cdp = None
+
+    async def start_browser(self):
+        """Initialize browser context and page"""
+        viewport = {
+            'width': self.config.viewport_width,
             'height': self.config.viewport_height
-        })
-        
-    def stop_browser(self):
-        """Clean up browser resources"""
-        if self.browser:
-            self.browser.close()
-        if self.playwright:
-            self.playwright.stop()
-            
-    def take_screenshot(self) -> str:
+        }
+        if self.pool:
+            self.context = await self.pool.acquire(viewport)
+        else:
+            self.playwright = await async_playwright().start()
+            self.browser = await self.playwright.chromium.launch(
+                headless=self.config.headless, args=_LAUNCH_ARGS
+            )
+            self.context = await self.browser.new_context(viewport=viewport)
+        self.page = await self.context.new_page()
+        self._cdp = await self.context.new_cdp_session(self.page)
+
+    async def stop_browser(self):
+        """Clean up browser resources; a pooled browser stays warm"""
+        if self.pool:
+            if self.context:
+                await self.pool.release(self.context)
+        else:
+            if self.browser:
+                await self.browser.close()
+            if self.playwright:
+                await self.playwright.stop()
+        self.context = None
+        self.page = None
+        self._cdp = None
+
+    async def take_screenshot(self) -> str:
         """Take screenshot and return as base64 string"""
         if not self.page:
             raise RuntimeError("Browser not initialized")
-            
-        screenshot = self.page.screenshot()
-        return base64.b64encode(screenshot).decode()
-        
-    def parse_and_execute_action(self, response_text: str) -> bool:
-        """Parse action from response and execute it"""
+
+        # CDP returns base64 straight from Chromium's own JPEG encoder, so no
+        # Python-side encode pass is needed at all
+        result = await self._cdp.send("Page.captureScreenshot", {
+            "format": "jpeg",
+            "quality": self.config.jpeg_quality,
+            "captureBeyondViewport": False
+        })
+        screenshot = result["data"]
+        self._screenshot_hash = _dhash(base64.b64decode(screenshot))
+        return screenshot
+
+    async def parse_and_execute_action(self, response_text: str) -> Optional[str]:
+        """Parse action from response and execute it; returns the action name"""
         try:
-            # Try to extract JSON from the response
-            json_match = re.search(r'```json\s*(\{.*?\})\s*```', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                action_data = json.loads(json_str)
-            else:
-                # Try to find JSON directly
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    action_data = json.loads(json_match.group())
-                else:
-                    print("No valid JSON found in response")
-                    return False
-            
+            action_data = _extract_action_json(response_text)
+            if action_data is None:
+                print("No valid JSON found in response")
+                return None
+
             action = action_data.get("action")
             details = action_data.get("details", {})
-            
+
             if action == "click":
                 # Look for coordinates or try to find element
                 if "x" in details and "y" in details:
-                    self.page.mouse.click(details["x"], details["y"])
+                    await self.page.mouse.click(details["x"], details["y"])
                 elif "selector" in details:
-                    self.page.click(details["selector"])
+                    await self.page.click(details["selector"])
                 else:
                     print("Click action missing coordinates or selector")
-                    return False
-                    
+                    return None
+
             elif action == "type" or action == "type_search_query":
                 # Type text, either directly or in a specific field
                 text = details.get("query") or details.get("text", "")
                 if "selector" in details:
-                    self.page.fill(details["selector"], text)
+                    await self.page.fill(details["selector"], text)
                 else:
-                    # Try to find search input
-                    try:
-                        self.page.fill('input[name="q"]', text)  # Google search
-                    except:
-                        try:
-                            self.page.fill('input[type="search"]', text)
-                        except:
-                            self.page.keyboard.type(text)
-                            
+                    # Probe candidates with instant DOM counts; a blind fill()
+                    # waits out its full actionability timeout before failing
+                    for sel in ('input[name="q"]', 'input[type="search"]', 'textarea[name="q"]'):
+                        loc = self.page.locator(sel)
+                        if await loc.count():
+                            await loc.first.fill(text, timeout=2000)
+                            break
+                    else:
+                        await self.page.keyboard.type(text)
+
             elif action == "press_enter" or action == "submit":
-                self.page.keyboard.press("Enter")
-                
+                await self.page.keyboard.press("Enter")
+
             elif action == "click_search" or action == "search":
-                # Try to click search button
-                try:
-                    self.page.click('input[value="Google Search"]')
-                except:
-                    try:
-                        self.page.click('button[type="submit"]')
-                    except:
-                        self.page.keyboard.press("Enter")
-                        
+                # Try search buttons in priority order, Enter as the fallback
+                for sel in ('input[value="Google Search"]', 'button[type="submit"]'):
+                    loc = self.page.locator(sel)
+                    if await loc.count():
+                        await loc.first.click(timeout=500)
+                        break
+                else:
+                    await self.page.keyboard.press("Enter")
+
             elif action == "scroll":
                 delta_y = details.get("delta_y", 300)
-                self.page.mouse.wheel(0, delta_y)
-                
+                await self.page.mouse.wheel(0, delta_y)
+
             elif action == "wait":
-                time.sleep(details.get("seconds", 1))
-                
+                await asyncio.sleep(details.get("seconds", 1))
+
             else:
                 print(f"Unknown action: {action}")
-                return False
-                
-            return True
-            
+                return None
+
+            return action
+
         except json.JSONDecodeError as e:
             print(f"JSON parsing error: {e}")
-            return False
+            return None
         except Exception as e:
             print(f"Error executing action: {e}")
-            return False
-            
-    def call_cua_api(self, screenshot: str, instruction: str, conversation_history: List[Dict]) -> Dict[str, Any]:
-        """Call OpenAI API with screenshot and instruction"""
-        
-        system_prompt = """You are a computer-using agent. Analyze the screenshot and provide the next action to take.
+            return None
 
-Available actions:
-- type_search_query: Type text in search field. Format: {"action": "type_search_query", "details": {"query": "text to type"}}
-- click: Click at coordinates or selector. Format: {"action": "click", "details": {"x": 100, "y": 200}} or {"action": "click", "details": {"selector": "button"}}
-- press_enter: Press Enter key. Format: {"action": "press_enter", "details": {}}
-- click_search: Click search button. Format: {"action": "click_search", "details": {}}
-- scroll: Scroll page. Format: {"action": "scroll", "details": {"delta_y": 300}}
-- wait: Wait for seconds. Format: {"action": "wait", "details": {"seconds": 2}}
+    async def _wait_after_action(self, action: str):
+        """Wait for the action's observable effect instead of a fixed sleep"""
+        try:
+            if action in ("click", "press_enter", "submit", "click_search", "search"):
+                await self.page.wait_for_load_state('networkidle', timeout=2000)
+            elif action in ("type", "type_search_query"):
+                await self.page.wait_for_function(
+                    "['INPUT', 'TEXTAREA'].includes(document.activeElement.tagName)",
+                    timeout=500
+                )
+            # scroll and wait need no extra settling time
+        except Exception:
+            # Timing out just means the page is still busy; screenshot what we have
+            pass
 
-Always respond with valid JSON in the format above. If the task appears complete, include "task_complete": true in your response."""
-        
-        messages = [{
-            "role": "system",
-            "content": system_prompt
-        }] + conversation_history + [{
-            "role": "user",
-            "content": [
+    def _summarize_turn(self, response_text: str) -> str:
+        """Distill an assistant turn to a one-line action summary"""
+        match = _ACTION_NAME.search(response_text)
+        action = match.group(1) if match else "unknown"
+        return f"previous action: {action}"
+
+    def _condense_history(self) -> None:
+        """Cap history cost: turns that fell out of the window become one-liners"""
+        cutoff = max(len(self._messages) - self.config.history_window, 1)
+        for i in range(self._condensed_upto, cutoff):
+            turn = self._messages[i]
+            if turn["role"] == "assistant":
+                turn["content"] = self._summarize_turn(turn["content"])
+        self._condensed_upto = max(self._condensed_upto, cutoff)
+
+    def _build_user_turn(self, screenshot: Optional[str], instruction: str) -> Dict[str, Any]:
+        """Build the user message for one CUA step"""
+
+        if screenshot is not None:
+            user_content = [
                 {
                     "type": "text",
                     "text": f"Task: {instruction}\n\nAnalyze this screenshot and provide the next action as JSON:"
@@ -166,65 +306,168 @@ Always respond with valid JSON in the format above. If the task appears complete
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/png;base64,{screenshot}"
+                        "url": f"data:image/jpeg;base64,{screenshot}"
                     }
                 }
             ]
-        }]
-        
+        else:
+            # Page is visually unchanged; skip the image and say so instead
+            user_content = (
+                f"Task: {instruction}\n\n"
+                "The page did not change after the last action. "
+                "Suggest a different action as JSON:"
+            )
+
+        return {"role": "user", "content": user_content}
+
+    async def call_cua_api(self, screenshot: Optional[str], instruction: str) -> Dict[str, Any]:
+        """Call OpenAI API with screenshot and instruction"""
+
+        self._condense_history()
+        user_turn = self._build_user_turn(screenshot, instruction)
+        self._messages.append(user_turn)
+
         try:
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.config.model,
-                messages=messages,
+                messages=self._messages,
                 max_tokens=1000,
                 temperature=0.1
             )
-            
+
+            response_text = response.choices[0].message.content
+            self._messages.append({
+                "role": "assistant",
+                "content": response_text
+            })
+
             return {
                 "success": True,
-                "response": response.choices[0].message.content,
+                "response": response_text,
                 "usage": response.usage
             }
-            
+
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+        finally:
+            # This turn is history now; the next step carries its own screenshot
+            if isinstance(user_turn["content"], list):
+                user_turn["content"] = user_turn["content"][0]["text"]
+
+    async def submit_batch(self, tasks: List[Tuple[str, str]], poll_interval: float = 30.0) -> Dict[str, Any]:
+        """Run many independent CUA steps through the OpenAI Batch API
+
+        Each task is an (instruction, screenshot_b64) pair. Batch requests get
+        50% pricing and a separate rate-limit pool, but may take up to 24h, so
+        use this for offline planning/eval sweeps rather than live stepping.
+        Returns response text per custom_id, with failed requests reported
+        separately under "errors".
+        """
+
+        lines = []
+        for i, (instruction, screenshot) in enumerate(tasks):
+            lines.append(json.dumps({
+                "custom_id": f"task-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.config.model,
+                    "messages": [self._SYSTEM_MSG, self._build_user_turn(screenshot, instruction)],
+                    "max_tokens": 1000,
+                    "temperature": 0.1
+                }
+            }))
+
+        try:
+            input_file = await self.client.files.create(
+                file=("cua_batch.jsonl", "\n".join(lines).encode()),
+                purpose="batch"
+            )
+            batch = await self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(poll_interval)
+                batch = await self.client.batches.retrieve(batch.id)
+
+            if batch.status != "completed":
+                return {
+                    "success": False,
+                    "error": f"Batch ended with status: {batch.status}"
+                }
+
+            output = await self.client.files.content(batch.output_file_id)
+            results = {}
+            errors = {}
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response")
+                if response is None:
+                    # Failed requests carry a null response and a populated
+                    # error field; record them without voiding the batch
+                    errors[record["custom_id"]] = record.get("error")
+                    continue
+                results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+
+            return {
+                "success": True,
+                "results": results,
+                "errors": errors
+            }
+
         except Exception as e:
             return {
                 "success": False,
                 "error": str(e)
             }
-            
-    def run_task(self, instruction: str, start_url: str = "https://www.google.com") -> Dict[str, Any]:
+
+    async def run_task(self, instruction: str, start_url: str = "https://www.google.com") -> Dict[str, Any]:
         """Run a complete CUA task"""
-        
-        self.start_browser()
-        conversation_history = []
-        
+
+        await self.start_browser()
+        self._messages = [self._SYSTEM_MSG]
+        self._condensed_upto = 1
+        self._screenshot_hash = None
+
         try:
             # Navigate to starting URL
-            self.page.goto(start_url)
-            
+            await self.page.goto(start_url)
+
             for step in range(self.config.max_steps):
                 print(f"Step {step + 1}: Taking screenshot...")
-                screenshot = self.take_screenshot()
-                
+                previous_hash = self._screenshot_hash
+                screenshot = await self.take_screenshot()
+
+                # If the page looks the same as last step, don't pay to resend
+                # the image; tell the model the action had no visible effect
+                if previous_hash is not None:
+                    distance = bin(self._screenshot_hash ^ previous_hash).count('1')
+                    if distance < _UNCHANGED_HASH_DISTANCE:
+                        print(f"Step {step + 1}: Page unchanged, skipping screenshot upload")
+                        screenshot = None
+
                 print(f"Step {step + 1}: Calling CUA API...")
-                result = self.call_cua_api(screenshot, instruction, conversation_history)
-                
+                result = await self.call_cua_api(screenshot, instruction)
+
                 if not result["success"]:
                     return {
                         "success": False,
                         "error": f"API call failed: {result['error']}",
                         "step": step + 1
                     }
-                
+
                 response_text = result["response"]
                 print(f"Step {step + 1}: Response: {response_text}")
-                
-                # Add to conversation history
-                conversation_history.append({
-                    "role": "assistant",
-                    "content": response_text
-                })
-                
+
                 # Check if task is complete
                 if "task_complete" in response_text.lower() or "done" in response_text.lower():
                     return {
@@ -232,41 +475,66 @@ Always respond with valid JSON in the format above. If the task appears complete
                         "message": "Task completed successfully",
                         "steps": step + 1
                     }
-                
+
                 # Parse and execute action
-                action_success = self.parse_and_execute_action(response_text)
-                if action_success:
+                executed_action = await self.parse_and_execute_action(response_text)
+                if executed_action:
                     print(f"Step {step + 1}: Action executed successfully")
-                    # Wait a bit for page to load
-                    time.sleep(2)
+                    await self._wait_after_action(executed_action)
                 else:
                     print(f"Step {step + 1}: Action execution failed")
-                
+
             return {
                 "success": False,
                 "message": "Max steps reached without completion",
                 "steps": self.config.max_steps
             }
-            
+
+        finally:
+            await self.stop_browser()
+
+    async def run_tasks(self, instructions: List[str], concurrency: int = 3) -> List[Dict[str, Any]]:
+        """Run multiple independent tasks concurrently on one event loop"""
+
+        semaphore = asyncio.Semaphore(concurrency)
+        pool = self.pool or BrowserPool(headless=self.config.headless)
+
+        async def run_one(instruction: str) -> Dict[str, Any]:
+            # Each task gets its own agent (and context) so page state is isolated
+            agent = ComputerUsingAgent(self.config, pool=pool)
+            async with semaphore:
+                try:
+                    return await agent.run_task(instruction)
+                except Exception as e:
+                    # Contain browser/navigation errors so one failed task
+                    # doesn't tear down the shared pool under its siblings
+                    return {
+                        "success": False,
+                        "error": str(e)
+                    }
+
+        try:
+            return await asyncio.gather(*(run_one(i) for i in instructions))
         finally:
-            self.stop_browser()
+            if pool is not self.pool:
+                await pool.stop()
 
-def main():
+async def main():
     """Example usage"""
-    
+
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         print("Please set OPENAI_API_KEY environment variable")
         return
-        
+
     config = CUAConfig(openai_api_key=api_key)
     agent = ComputerUsingAgent(config)
-    
+
     # Example task
     instruction = "Search for 'OpenAI' on Google"
-    result = agent.run_task(instruction)
-    
+    result = await agent.run_task(instruction)
+
     print(f"Task result: {result}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())